@@ -1,3 +1,4 @@
+import codecs
 import csv
 import logging
 import os
@@ -6,90 +7,217 @@ import re
 import subprocess
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Flag, auto
 from fnmatch import fnmatch
-from functools import reduce
-from operator import or_
+from functools import partial, reduce
+from io import StringIO
+from operator import itemgetter, or_
 from pathlib import Path
-from typing import Collection, Iterator, Optional
+from typing import Callable, Iterable, Iterator, List, Optional, Pattern, Sequence, Set, TextIO, Tuple, TypeVar
 
-from genutility._files import to_dos_path
+from genutility._files import MyDirEntryT, to_dos_path
 from genutility.args import ascii, base64, is_dir, suffix_lower
 from genutility.file import is_all_byte, read_file
 from genutility.filesystem import PathType, scandir_counts, scandir_error_log_warning, scandir_ext, scandir_rec
-from genutility.os import islink, realpath
+from genutility.os import islink
 from genutility.rich import MarkdownHighlighter, Progress, StdoutFileNoStyle, get_double_format_columns
 from genutility.win.file import GetCompressedFileSize
+from more_itertools import chunked
 from rich.logging import RichHandler
 from rich.progress import Progress as RichProgress
 from send2trash import send2trash
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+U = TypeVar("U")
 
-def is_sparse_or_compressed(entry: os.DirEntry) -> bool:
-    return GetCompressedFileSize(entry.path) < entry.stat().st_size
+BATCH_SIZE = 512
+ZERO_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_SEARCH_BUFFER_SIZE = 64 * 1024 * 1024
+DECODE_CHUNK_SIZE = 4 * 1024 * 1024
 
 
-def _files(path: PathType, include: Collection[str], exclude: Collection[str], progress: Progress):
-    include = set(include) if include is not None else None
-    exclude = set(exclude) if exclude is not None else None
+def is_sparse_or_compressed(path: str, size: int) -> bool:
+    return GetCompressedFileSize(path) < size
 
-    yield from p.track(
+
+def _files(
+    path: PathType, include: Optional[Set[str]], exclude: Optional[Set[str]], progress: Progress
+) -> Iterator[MyDirEntryT]:
+    yield from progress.track(
         scandir_ext(path, include, exclude, errorfunc=scandir_error_log_warning),
         description="Processed {task.completed} files",
     )
 
 
+def _map_batched(executor: ThreadPoolExecutor, func: Callable[[T], U], it: Iterable[T]) -> Iterator[U]:
+    """Like `executor.map`, but only `BATCH_SIZE` items are submitted at once."""
+
+    for batch in chunked(it, BATCH_SIZE):
+        yield from executor.map(func, batch)
+
+
+def _check_encoding(path: str, encoding: str) -> Tuple[str, Optional[str]]:
+    # decode raw chunks directly, the text layer would only add newline translation and buffering
+    decoder = codecs.getincrementaldecoder(encoding)("strict")
+    try:
+        with open(path, "rb", buffering=0) as fr:
+            for chunk in iter(partial(fr.read, DECODE_CHUNK_SIZE), b""):
+                decoder.decode(chunk)
+            decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return path, f"{path} failed to decode"
+    except PermissionError:
+        return path, f"Cannot access {path}"
+    return path, None
+
+
 def bad_encoding(args: Namespace, progress: Progress) -> int:
-    with StdoutFileNoStyle(progress.progress.console, args.out, "xt") as fw:
-        for entry in _files(args.path, args.include_extensions, args.exclude_extensions, progress):
-            try:
-                with open(entry, encoding=args.encoding) as fr:
-                    fr.read()
-            except UnicodeDecodeError:
-                fw.write(f"{entry.path} failed to decode\n")
-            except PermissionError:
-                fw.write(f"Cannot access {entry.path}\n")
-            else:
-                if args.verbose:
-                    fw.write(f"{entry.path}\n")
+    entries = _files(args.path, args.include_extensions, args.exclude_extensions, progress)
+    paths = (entry.path for entry in entries)
+
+    with StdoutFileNoStyle(progress.progress.console, args.out, "xt") as fw, ThreadPoolExecutor(
+        args.workers
+    ) as executor:
+        for path, error in _map_batched(executor, partial(_check_encoding, encoding=args.encoding), paths):
+            if error is not None:
+                fw.write(f"{error}\n")
+            elif args.verbose:
+                fw.write(f"{path}\n")
     return 0
 
 
+def _search_lines(patterns: Sequence[Pattern], lines: Iterable[str], early_stop: bool) -> Iterator[Tuple[int, str]]:
+    active = dict(enumerate(patterns))
+    for line in lines:
+        for i, pattern in list(active.items()):
+            if pattern.search(line):
+                yield i, line
+                if early_stop:
+                    del active[i]
+        if not active:
+            break
+
+
+def _search_buffer(pattern: Pattern, ml_pattern: Pattern, data: str, early_stop: bool) -> Optional[List[str]]:
+    """Finds the lines of `data` which match `pattern` by running the multiline version of the pattern
+    `ml_pattern` over the whole buffer. Returns None if the result could differ from searching line by line.
+    """
+
+    out: List[str] = []
+    line_end = 0
+    for m in ml_pattern.finditer(data):
+        start, end = m.span()
+        if start < line_end:  # line was already found
+            if end > line_end:
+                return None
+            continue
+
+        line_start = data.rfind("\n", 0, start) + 1
+        if line_start == len(data):  # empty match after the last line
+            break
+        line_end = data.find("\n", start) + 1 or len(data) + 1
+
+        line = data[line_start:line_end]
+        if end > line_end or not pattern.search(line):  # match spans lines or depends on its surroundings
+            return None
+
+        out.append(line)
+        if early_stop:
+            break
+
+    return out
+
+
+def _multiline_pattern(pattern: Pattern) -> Optional[Pattern]:
+    # whole buffer search is only equivalent if the pattern doesn't rely on string boundaries or lookarounds
+    if any(token in pattern.pattern for token in ("\\A", "\\Z", "(?<", "(?=", "(?!")):
+        return None
+    return re.compile(pattern.pattern, pattern.flags | re.MULTILINE)
+
+
+def _search_file(
+    fr: TextIO, size: int, patterns: Sequence[Tuple[Pattern, Optional[Pattern]]], early_stop: bool
+) -> List[Tuple[int, str]]:
+    """Returns (pattern index, line) pairs for all matching lines in `fr`, ordered by pattern and line."""
+
+    if size > MAX_SEARCH_BUFFER_SIZE:
+        matches = _search_lines([pattern for pattern, _ in patterns], fr, early_stop)
+        return sorted(matches, key=itemgetter(0))
+
+    data = fr.read()
+    out: List[Tuple[int, str]] = []
+    for i, (pattern, ml_pattern) in enumerate(patterns):
+        lines: Optional[List[str]] = None
+        if ml_pattern is not None:
+            lines = _search_buffer(pattern, ml_pattern, data, early_stop)
+        if lines is None:
+            lines = [line for _, line in _search_lines([pattern], StringIO(data, newline="\n"), early_stop)]
+        out.extend((i, line) for line in lines)
+    return out
+
+
 def line_search_regex(args: Namespace, progress: Progress) -> int:
+    patterns = [(pattern, _multiline_pattern(pattern)) for pattern in args.pattern]
+    multiple = len(patterns) > 1
+
     num = 0
     with StdoutFileNoStyle(progress.progress.console, args.out, "xt", newline="") as csvfile:
         csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(["path", "line"])
+        if multiple:
+            csvwriter.writerow(["path", "pattern", "line"])
+        else:
+            csvwriter.writerow(["path", "line"])
 
         for entry in _files(args.path, args.include_extensions, args.exclude_extensions, progress):
             with open(entry.path, encoding=args.encoding, errors=args.errors) as fr:
-                for line in fr:
-                    m = args.pattern.search(line)
-                    if m:
-                        num += 1
-                        csvwriter.writerow([entry.path, line])
-                        if args.early_stop:
-                            break
+                matches = _search_file(fr, entry.stat().st_size, patterns, args.early_stop)
+
+            for i, line in matches:
+                num += 1
+                if multiple:
+                    csvwriter.writerow([entry.path, args.pattern[i].pattern, line])
+                else:
+                    csvwriter.writerow([entry.path, line])
 
     logger.info("Found %d matches", num)
     return 0
 
 
+def is_all_zero(path: str, size: int) -> bool:
+    # unbuffered, so chunks are read directly without an additional copy
+    with open(path, "rb", buffering=0) as fr:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fr.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return is_all_byte(fr, b"\x00", min(size, ZERO_CHUNK_SIZE))
+
+
+def _all_zero_row(entry: MyDirEntryT) -> Optional[Tuple[str, int, int]]:
+    # `_files` doesn't follow symlinks, so the stat cached by scandir (on Windows) can be used
+    stat = entry.stat(follow_symlinks=False)
+    if stat.st_size == 0:
+        return None
+
+    if is_all_zero(entry.path, stat.st_size):
+        return entry.path, stat.st_size, stat.st_mtime_ns
+    return None
+
+
 def all_zero(args: Namespace, progress: Progress) -> int:
     num = 0
-    with StdoutFileNoStyle(progress.progress.console, args.out, "xt", newline="") as csvfile:
+    with StdoutFileNoStyle(progress.progress.console, args.out, "xt", newline="") as csvfile, ThreadPoolExecutor(
+        args.workers
+    ) as executor:
         csvwriter = csv.writer(csvfile)
         csvwriter.writerow(["path", "filesize", "mtime"])
 
-        for entry in _files(args.path, args.include_extensions, args.exclude_extensions, progress):
-            stat = entry.stat()
-            if stat.st_size != 0:
-                with open(entry.path, "rb") as fr:
-                    if is_all_byte(fr, b"\x00"):
-                        num += 1
-                        csvwriter.writerow([entry.path, stat.st_size, stat.st_mtime_ns])
+        entries = _files(args.path, args.include_extensions, args.exclude_extensions, progress)
+        for row in _map_batched(executor, _all_zero_row, entries):
+            if row is not None:
+                num += 1
+                csvwriter.writerow(row)
 
     logger.info("Found %d all-zero files", num)
     return 0
@@ -111,15 +239,24 @@ def has_filesize(args: Namespace, progress: Progress) -> int:
     return 0
 
 
+def _check_sparse_or_compressed(entry: MyDirEntryT) -> Optional[str]:
+    # `_files` only yields regular files and doesn't follow symlinks, so the scandir stat can be used as is
+    try:
+        if is_sparse_or_compressed(entry.path, entry.stat(follow_symlinks=False).st_size):
+            return entry.path
+    except OSError as e:
+        logger.warning("Error reading filesize of `%s`: %s", entry.path, e)
+    return None
+
+
 def sparse_or_compressed(args: Namespace, progress: Progress) -> int:
-    with StdoutFileNoStyle(progress.progress.console, args.out, "xt") as fw:
-        for entry in _files(args.path, args.include_extensions, args.exclude_extensions, progress):
-            if entry.is_file():
-                try:
-                    if is_sparse_or_compressed(entry):
-                        fw.write(f"Sparse or compressed: {entry.path}\n")
-                except OSError as e:
-                    logger.warning("Error reading filesize of `%s`: %s", entry.path, e)
+    with StdoutFileNoStyle(progress.progress.console, args.out, "xt") as fw, ThreadPoolExecutor(
+        args.workers
+    ) as executor:
+        entries = _files(args.path, args.include_extensions, args.exclude_extensions, progress)
+        for path in _map_batched(executor, _check_sparse_or_compressed, entries):
+            if path is not None:
+                fw.write(f"Sparse or compressed: {path}\n")
     return 0
 
 
@@ -130,6 +267,15 @@ class LinkModes(Flag):
     invalid = auto()
 
 
+def _link_target_exists(path: str) -> bool:
+    # `os.stat` resolves the whole link chain itself, so `realpath` + `exists` is not needed
+    try:
+        os.stat(path, follow_symlinks=True)
+    except OSError:
+        return False
+    return True
+
+
 def symlinks(args: Namespace, progress: Progress) -> int:
     mode = reduce(or_, [LinkModes[mode] for mode in args.modes])
 
@@ -170,10 +316,10 @@ def symlinks(args: Namespace, progress: Progress) -> int:
                     if LinkModes.valid in mode and LinkModes.invalid in mode:
                         fw.write(f"{entry.path}\n")
                     elif LinkModes.valid in mode:
-                        if os.path.exists(realpath(entry.path)):
+                        if _link_target_exists(entry.path):
                             fw.write(f"{entry.path}\n")
                     elif LinkModes.invalid in mode:
-                        if not os.path.exists(realpath(entry.path)):
+                        if not _link_target_exists(entry.path):
                             fw.write(f"{entry.path}\n")
                     else:
                         assert False  # noqa: B011
@@ -208,6 +354,19 @@ def force_decode(data: bytes, path: str) -> str:
             return data.decode("latin1")  # should never fail
 
 
+def _run_command(command: str, shell: bool, capture_output: bool, path: str) -> None:
+    # stdout is only kept if requested, otherwise only stderr is used for error messages
+    if capture_output:
+        proc = subprocess.run(command, shell=shell, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.stdout
+    else:
+        proc = subprocess.run(command, shell=shell, cwd=path, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        output = proc.stderr
+
+    if proc.returncode != 0:
+        logger.error("Calling `%s` in `%s` failed: %s", command, path, force_decode(output, path))
+
+
 def find_and_run(args: Namespace, progress: Progress) -> int:
     if (args.file_name is None) == (args.dir_name is None):
         raise ValueError("either --file-name or --dir-name must be given")
@@ -219,16 +378,18 @@ def find_and_run(args: Namespace, progress: Progress) -> int:
         )
     )
 
-    for _path in progress.track(paths, description="Processed {task.completed}/{task.total:.0f} paths"):
-        path = os.fspath(_path)
-
-        if not args.device_path:
-            path = to_dos_path(path)
+    if args.device_path:
+        cwds = [os.fspath(path) for path in paths]
+    else:
+        cwds = [to_dos_path(os.fspath(path)) for path in paths]
 
-        try:
-            subprocess.check_output(args.command, shell=args.shell, cwd=path, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            logger.error("Calling `%s` in `%s` failed: %s", e.cmd, path, force_decode(e.output, path))
+    func = partial(_run_command, args.command, args.shell, args.capture_output)
+    with ThreadPoolExecutor(args.jobs) as executor:
+        futures = [executor.submit(func, cwd) for cwd in cwds]
+        for future in progress.track(
+            as_completed(futures), total=len(futures), description="Processed {task.completed}/{task.total:.0f} paths"
+        ):
+            future.result()
 
     return 0
 
@@ -316,6 +477,7 @@ if __name__ == "__main__":
     import sys
 
     DEFAULT_ENCODING = "utf-8"
+    DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
 
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
     subparsers = parser.add_subparsers(dest="action", required=True)
@@ -365,6 +527,18 @@ if __name__ == "__main__":
         action="store_true",
         help="Use DOS device path as the commands current directory. Doesn't support --shell and also might cause issues when the command calls other processes.",
     )
+    subparser_e.add_argument(
+        "--capture-output",
+        action="store_true",
+        help="Include the stdout of failed commands in the error message, otherwise only stderr is shown",
+    )
+    subparser_e.add_argument(
+        "--jobs",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Number of commands to run at the same time. Only use more than one if the commands are independent of each other.",
+    )
 
     ALL_ERRORS = (
         "strict",
@@ -385,8 +559,17 @@ Find cue files which contain catalog meta data:
 find.py -i .cue line-search-regex -p "^CATALOG" .""",  # %(prog)s adds the action which doesn't allow other flags
     )
     subparser_f.set_defaults(func=line_search_regex)
-    subparser_f.add_argument("-p", "--pattern", type=re.compile, required=True, help="Pattern to match line")
-    subparser_f.add_argument("--early-stop", action="store_true", help="Stop processing file after first match")
+    subparser_f.add_argument(
+        "-p",
+        "--pattern",
+        type=re.compile,
+        action="append",
+        required=True,
+        help="Pattern to match line. Can be given multiple times, in which case a pattern column is added to the output.",
+    )
+    subparser_f.add_argument(
+        "--early-stop", action="store_true", help="Stop processing file after first match (per pattern)"
+    )
     subparser_f.add_argument("--encoding", default="utf-8", help="File encoding")
     subparser_f.add_argument("--errors", choices=ALL_ERRORS, default="replace", help="File decoding error handling")
 
@@ -453,12 +636,24 @@ find.py -i .cue line-search-regex -p "^CATALOG" .""",  # %(prog)s adds the actio
         help="File extensions not to process",
     )
 
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of concurrent threads used by bad-encoding, all-zero and sparse-or-compressed",
+    )
     parser.add_argument("--out", type=Path, help="Write output to file, otherwise to stdout")
     parser.add_argument("--log", type=Path, help="Write logs to file, otherwise to stderr")
     parser.add_argument("-v", "--verbose", action="store_true")
 
     args = parser.parse_args()
 
+    if args.include_extensions is not None:
+        args.include_extensions = set(args.include_extensions)
+    if args.exclude_extensions is not None:
+        args.exclude_extensions = set(args.exclude_extensions)
+
     handler = RichHandler(log_time_format="%Y-%m-%d %H-%M-%S%Z", highlighter=MarkdownHighlighter())
     FORMAT = "%(message)s"
 
@@ -1,20 +1,41 @@
+import re
 from os import fspath
 from pathlib import Path
+from string import Formatter
 from typing import TYPE_CHECKING
 
 from genutility.file import read_file
 
 if TYPE_CHECKING:
-    from typing import FrozenSet
+    from typing import Any, Callable, Dict, FrozenSet
 
 
 def esc(s):
     return s.replace("\\", "\\\\")
 
 
+FIELDS: "Dict[str, Callable[[Path], Any]]" = {
+    "filename": lambda path: path.name,
+    "efilename": lambda path: esc(path.name),
+    "path": fspath,
+    "epath": lambda path: esc(fspath(path)),
+    "stem": lambda path: path.parent / path.stem,  # path without suffix
+}
+
+
+def template_fields(tpl: str) -> "Dict[str, Callable[[Path], Any]]":
+    """Returns the field functions for all placeholders which are used in `tpl`."""
+
+    names = {
+        re.split(r"[.\[]", field_name, maxsplit=1)[0] for _, field_name, _, _ in Formatter().parse(tpl) if field_name
+    }
+    return {name: func for name, func in FIELDS.items() if name in names}
+
+
 def main(inpath: Path, tplpath: Path, outpath: Path, suffixes: FrozenSet[str] = frozenset(), prepend: str = "") -> None:
     tpl = read_file(tplpath, "rt")
     assert isinstance(tpl, str)  # for mypy
+    fields = template_fields(tpl)
 
     paths = [path for path in inpath.iterdir() if path.suffix in suffixes]
 
@@ -22,16 +43,7 @@ def main(inpath: Path, tplpath: Path, outpath: Path, suffixes: FrozenSet[str] =
         fw.write(prepend.format(num=len(paths)))
 
         for i, path in enumerate(paths):
-            fw.write(
-                tpl.format(
-                    filename=path.name,
-                    efilename=esc(path.name),
-                    path=fspath(path),
-                    epath=esc(fspath(path)),
-                    stem=path.parent / path.stem,  # path without suffix
-                    i=i,
-                )
-            )
+            fw.write(tpl.format(i=i, **{name: func(path) for name, func in fields.items()}))
 
 
 if __name__ == "__main__":
@@ -4,7 +4,7 @@ from argparse import ArgumentParser, Namespace
 from collections import Counter
 from ctypes import WinError, byref, create_string_buffer, sizeof
 from pathlib import Path
-from struct import unpack
+from struct import Struct
 from typing import List, NamedTuple
 
 from cwinsdk.km.wdm import IO_STATUS_BLOCK
@@ -14,6 +14,7 @@ from cwinsdk.um.fileapi import OPEN_EXISTING, CreateFileW
 from cwinsdk.um.handleapi import CloseHandle
 from cwinsdk.um.winnt import FILE_GENERIC_READ
 from cwinsdk.um.winternl import RtlNtStatusToDosError
+from genutility.filesystem import scandir_error_log_warning, scandir_rec
 from genutility.rich import MarkdownHighlighter, Progress
 from rich.logging import RichHandler
 from rich.progress import Progress as RichProgress
@@ -26,13 +27,19 @@ class EA(NamedTuple):
     value: bytes
 
 
+# FILE_FULL_EA_INFORMATION header: NextEntryOffset, Flags, EaNameLength, EaValueLength
+EA_HEADER = Struct("<LBBH")
+
+
 def parse_buffer(buffer: Buffer) -> List[EA]:
     out: List[EA] = []
     offset = 0
     while True:
-        NextEntryOffset, Flags, EaNameLength, EaValueLength = unpack("LBBH", buffer[offset : offset + 8])
-        EaName = buffer[offset + 8 : offset + 8 + EaNameLength]
-        EaValue = buffer[offset + 8 + EaNameLength + 1 : offset + 8 + EaNameLength + 1 + EaValueLength]
+        NextEntryOffset, Flags, EaNameLength, EaValueLength = EA_HEADER.unpack_from(buffer, offset)
+        name_start = offset + EA_HEADER.size
+        value_start = name_start + EaNameLength + 1  # name is null-terminated
+        EaName = buffer[name_start : name_start + EaNameLength]
+        EaValue = buffer[value_start : value_start + EaValueLength]
         out.append(EA(Flags, str(EaName, "ascii"), bytes(EaValue)))
         if NextEntryOffset == 0:
             break
@@ -80,25 +87,24 @@ def main(args: Namespace) -> int:
         logging.basicConfig(level=logging.INFO, format=FORMAT, handlers=[handler])
 
     if args.path.is_dir():
-        if args.recursive:
-            it = args.path.rglob("*")
-        else:
-            it = args.path.glob("*")
+        it = scandir_rec(
+            args.path,
+            files=True,
+            dirs=False,
+            others=False,
+            rec=args.recursive,
+            follow_symlinks=False,
+            errorfunc=scandir_error_log_warning,
+        )
 
         c = Counter()
 
         with RichProgress() as progress:
             p = Progress(progress)
-            for path in p.track(it):
-                try:
-                    if not path.is_file():
-                        continue
-                except PermissionError as e:
-                    logging.warning("Failed to access <%s>: %s", path, e)
-                    continue
-
+            for entry in p.track(it):
+                path = entry.path
                 try:
-                    ealist = read_ea(os.fspath(path))
+                    ealist = read_ea(path)
                 except OSError as e:
                     logging.error("Failed to read EA from <%s>: %s", path, e)
                     continue
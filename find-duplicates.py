@@ -1,20 +1,44 @@
 import logging
+import mmap
+import os
 import re
-from collections import defaultdict
+import sqlite3
+import sys
+from collections import defaultdict, deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from hashlib import sha1
 from itertools import combinations
+from operator import itemgetter
 from pathlib import Path
-from typing import Callable, Collection, DefaultDict, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    ContextManager,
+    DefaultDict,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 from genutility.exceptions import ParseError, Skip
 from genutility.fileformats.jfif import hash_raw_jpeg
 from genutility.fileformats.png import hash_raw_png
-from genutility.filesystem import PathType, entrysuffix, fileextensions, scandir_rec
+from genutility.filesystem import PathType, fileextensions, scandir_rec
 from genutility.fingerprinting import phash_blockmean
-from genutility.hash import hash_file
-from genutility.metrics import hamming_distance
+from genutility.os import islink
 from genutility.rich import Progress
-from metrictrees.bktree import BKTree
+from metrictrees.bktree import BKNode, BKTree
 from metrohash import MetroHash128
 from PIL import Image
 from rich.highlighter import NullHighlighter
@@ -22,17 +46,63 @@ from rich.logging import RichHandler
 from rich.progress import BarColumn, MofNCompleteColumn
 from rich.progress import Progress as RichProgress
 from rich.progress import TextColumn, TimeElapsedColumn
+from typing_extensions import Self
+from xxhash import xxh3_128
+
+T = TypeVar("T")
+
+MMAP_MIN_SIZE = 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file_mmap(path: str, hashcls: Callable[[], Any], buffer_protocol: bool = True) -> bytes:
+    """Hashes the file at `path` with `hashcls`. Large files are memory mapped and passed to the hash object
+    directly, which avoids copying them chunk by chunk into intermediate bytes objects.
+    If the hash object only accepts `bytes` (`buffer_protocol=False`), large files are read in chunks instead.
+    Afterwards they are dropped from the page cache where supported, since they are usually not read again
+    and would otherwise evict more useful pages.
+    """
+
+    m = hashcls()
+    with open(path, "rb", buffering=0) as fr:
+        if os.fstat(fr.fileno()).st_size < MMAP_MIN_SIZE:
+            m.update(fr.readall())
+            return m.digest()
+
+        if buffer_protocol:
+            with mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                m.update(mm)
+        else:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fr.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            for data in iter(partial(fr.read, READ_CHUNK_SIZE), b""):
+                m.update(data)
+
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fr.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return m.digest()
 
 
 def metrohash(path: str) -> bytes:
-    return hash_file(path, MetroHash128).digest()
+    # `MetroHash128.update` only accepts bytes, not mmap objects
+    return hash_file_mmap(path, MetroHash128, buffer_protocol=False)
 
 
-def nometahash(path: str) -> bytes:
+def xxh3(path: str) -> bytes:
+    return hash_file_mmap(path, xxh3_128)
+
+
+SHA1_PROTOTYPE = sha1()  # copying is cheaper than constructing a new hash object
+NOMETA_EXTS = (".jpg", ".jpeg", ".png")  # all other files are skipped by `_nometahash`
+
+
+def _nometahash(path: str, hashcls: Callable[[], Any]) -> bytes:
     lowerpath = path.lower()
 
     if lowerpath.endswith(".jpg") or lowerpath.endswith(".jpeg"):
-        hashobj = sha1()
+        hashobj = hashcls()
         try:
             hash_raw_jpeg(path, hashobj)
         except ParseError as e:
@@ -45,7 +115,7 @@ def nometahash(path: str) -> bytes:
         return hashobj.digest()
 
     elif lowerpath.endswith(".png"):
-        hashobj = sha1()
+        hashobj = hashcls()
         try:
             hash_raw_png(path, hashobj)
         except ParseError as e:
@@ -61,147 +131,652 @@ def nometahash(path: str) -> bytes:
         raise Skip()
 
 
-IGNORE_DIRNAMES = {".git"}
+def nometahash(path: str) -> bytes:
+    return _nometahash(path, SHA1_PROTOTYPE.copy)
 
 
-def iter_size_path(dirs: Iterable[PathType], include_symlinks: bool = False) -> Iterator[Tuple[int, str]]:
-    for dir in dirs:
-        for entry in scandir_rec(dir, dirs=True, others=True, follow_symlinks=False, allow_skip=True):
-            if entry.is_dir() and entry.name in IGNORE_DIRNAMES:
+def nometaxxh3(path: str) -> bytes:
+    return _nometahash(path, xxh3_128)
+
+
+IGNORE_DIRNAMES = {".git"}
+HASH_PREFETCH = 256
+SCAN_PREFETCH = 64
+PAIR_CHUNK_SIZE = 1024 * 1024
+SAMPLE_SIZE = 64 * 1024
+PHASH_SIZE = 256
+
+
+def _scan_dir(
+    path: str, include_symlinks: bool, exclude_names: Collection[str] = frozenset()
+) -> Tuple[List[str], List[Tuple[int, str]]]:
+    """Files are returned in inode order, which approximates their on-disk order on most POSIX filesystems
+    and reduces seeking when they are read later. On Windows `st_ino` is 0 here, so the listing order is kept.
+    """
+
+    subdirs: List[str] = []
+    files: List[Tuple[int, int, str]] = []
+
+    # regular files are by far the most common entries, so they are checked first.
+    # the is_* checks use the file type from the directory listing and don't need a syscall.
+    for entry in scandir_rec(path, dirs=True, others=True, rec=False, follow_symlinks=False):
+        if entry.name in exclude_names:
+            logging.debug("Skipped: %s", entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            # uses the cached lstat result, which on Windows comes from the directory listing without a syscall
+            stats = entry.stat(follow_symlinks=False)
+            files.append((stats.st_ino, stats.st_size, entry.path))
+        elif entry.is_dir(follow_symlinks=False):
+            if entry.name in IGNORE_DIRNAMES:
                 logging.debug("Skipped: %s", entry.path)
-                entry.follow = False
-            elif entry.is_symlink():
-                if include_symlinks:
-                    filesize = entry.stat().st_size
-                    yield filesize, entry.path
-            elif entry.is_file():
-                filesize = entry.stat().st_size
-                yield filesize, entry.path
+            elif not islink(entry):  # don't follow directory junctions
+                subdirs.append(entry.path)
+        elif entry.is_symlink():
+            if include_symlinks:
+                stats = entry.stat()  # stats of the link target
+                files.append((stats.st_ino, stats.st_size, entry.path))
+
+    files.sort(key=itemgetter(0))
+    return subdirs, [(filesize, filepath) for _, filesize, filepath in files]
+
+
+def iter_size_path(
+    dirs: Iterable[PathType],
+    include_symlinks: bool = False,
+    workers: Optional[int] = None,
+    exclude_names: Collection[str] = frozenset(),
+) -> Iterator[Tuple[int, str]]:
+    """Yields (size, path) for all files in `dirs`. Directories are scanned concurrently by `workers` threads,
+    but results are yielded in a deterministic breadth-first order. At most `SCAN_PREFETCH` directories
+    are scanned ahead of the consumer. Files and directories with a name in `exclude_names` are skipped.
+    """
+
+    # directories waiting to be scanned. they continue the breadth-first order where `pending` ends.
+    queue: Deque[str] = deque(os.fspath(dir) for dir in dirs)
+    pending: Deque["Future[Tuple[List[str], List[Tuple[int, str]]]]"] = deque()
+
+    with ThreadPoolExecutor(workers) as executor:
+        while queue or pending:
+            while queue and len(pending) < SCAN_PREFETCH:
+                pending.append(executor.submit(_scan_dir, queue.popleft(), include_symlinks, exclude_names))
+            subdirs, files = pending.popleft().result()
+            queue.extend(subdirs)
+            yield from files
+
+
+if sys.version_info >= (3, 10):
+
+    def hamming_distance(a: int, b: int) -> int:
+        return (a ^ b).bit_count()
+
+else:
+
+    def hamming_distance(a: int, b: int) -> int:
+        return bin(a ^ b).count("1")
+
+
+def _subtree_values(node: BKNode[int]) -> Iterator[int]:
+    yield node.value
+    for leaf in node.leaves.values():
+        yield from _subtree_values(leaf)
+
+
+def _groups_by_distance(node: BKNode[int], out: DefaultDict[int, List[Set[int]]], max_distance: int) -> None:
+    for d, bknode in node.leaves.items():
+        if d < max_distance:
+            nodeset = set(_subtree_values(bknode))
+            nodeset.add(node.value)
+            out[d].append(nodeset)
+        _groups_by_distance(bknode, out, max_distance)  # edges below can still be shorter
+
+
+def groups_by_distance(tree: BKTree[int], max_distance: int) -> Dict[int, List[Set[int]]]:
+    """Same as `{d: list(tree.find_by_distance(d)) for d in range(max_distance)}` but traverses the tree only once."""
+
+    out: DefaultDict[int, List[Set[int]]] = defaultdict(list)
+    if tree.root is not None:
+        _groups_by_distance(tree.root, out, max_distance)
+    return out
+
+
+class HashCache:
+    """Persistent sqlite cache of file hashes keyed by path, modification time and size.
+    `name` identifies the kind of hash, so different hashes can be stored in the same database.
+    """
+
+    def __init__(self, cachefile: PathType, name: str, batch_size: int = 500) -> None:
+        self.conn = sqlite3.connect(os.fspath(cachefile))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes (name TEXT, path TEXT, mtime INTEGER, size INTEGER, hash BLOB, PRIMARY KEY (name, path))"
+        )
+        self.name = name
+        self.batch_size = batch_size
+        self.pending = 0
+
+    def get(self, path: str, mtime: int, size: int) -> Optional[bytes]:
+        row = self.conn.execute(
+            "SELECT hash FROM hashes WHERE name=? AND path=? AND mtime=? AND size=?", (self.name, path, mtime, size)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set(self, path: str, mtime: int, size: int, hashbytes: bytes) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", (self.name, path, mtime, size, hashbytes)
+        )
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def open_cache(cachefile: Optional[PathType], name: str) -> ContextManager[Optional[HashCache]]:
+    """Opens the `HashCache` at `cachefile`, or returns a context manager for None if no file is given."""
+
+    if cachefile is None:
+        return nullcontext()
+    return HashCache(cachefile, name)
+
+
+# draft decoding changes the hashes, so they are cached under a different name than fully decoded ones.
+# change it whenever `_phash_image` produces different hashes for the same image.
+PHASH_CACHE_NAME = "phash-blockmean-draft"
+
+
+def _phash_image(path: str) -> bytes:
+    # the context manager closes the file and releases the decoded image as soon as the hash is computed
+    with Image.open(path, "r") as img:
+        # `phash_blockmean` only needs a grayscale image of PHASH_SIZE x PHASH_SIZE pixels.
+        # this lets the JPEG decoder downscale by up to 8x while decoding, other formats ignore it.
+        img.draft("L", (PHASH_SIZE, PHASH_SIZE))
+        img.load()  # force load so OSError can be caught here
+        return phash_blockmean(img, x=PHASH_SIZE)
+
+
+def _iter_image_paths(
+    dirs: Iterable[PathType],
+    exts: Collection,
+    include_symlinks: bool = False,
+    workers: Optional[int] = None,
+    exclude_names: Collection[str] = frozenset(),
+) -> Iterator[str]:
+    for _size, path in iter_size_path(dirs, include_symlinks, workers, exclude_names):
+        ext = os.path.splitext(path)[1][1:].lower()
+        if ext in exts:
+            yield path
+
+
+def _image_result(path: str, future: "Future[bytes]") -> Optional[bytes]:
+    try:
+        return future.result()
+    except OSError:
+        logging.warning("Cannot open image: %s", path)
+    return None
+
+
+def _done_future(result: bytes) -> "Future[bytes]":
+    future: "Future[bytes]" = Future()
+    future.set_result(result)
+    return future
+
+
+def _hash_images(
+    paths: Iterable[str],
+    executor: Executor,
+    cache: Optional[HashCache] = None,
+    raw_dedupe: bool = False,
+) -> Iterator[Tuple[str, Optional[bytes]]]:
+    """Decodes and hashes the images at `paths` using `executor` and yields `(path, hash)` in input order.
+    Images found in `cache` are not decoded again. `hash` is None for images which could not be opened.
+    If `raw_dedupe` is True, the raw image data of JPEG and PNG files is hashed first
+    and only one image per raw hash is decoded. Other formats are decoded directly.
+    """
+
+    # images wait in `rawpending` for their raw hash before they are submitted for decoding and moved to `pending`
+    rawpending: Deque[
+        Tuple[str, Optional[Tuple[str, int, int]], Optional["Future[bytes]"], Optional["Future[bytes]"]]
+    ] = deque()
+    pending: Deque[Tuple[str, Optional[Tuple[str, int, int]], Optional[bytes], "Future[bytes]"]] = deque()
+    decoded: Dict[bytes, Union[bytes, "Future[bytes]"]] = {}  # raw hash to image hash
+
+    def _decode() -> None:
+        path, cachekey, rawfuture, future = rawpending.popleft()
+        rawhash = None
+        if future is None:
+            assert rawfuture is not None
+            rawhash = _hash_result(path, rawfuture)
+            if rawhash is None:
+                future = executor.submit(_phash_image, path)
+            else:
+                value = decoded.get(rawhash)
+                if value is None:
+                    future = decoded[rawhash] = executor.submit(_phash_image, path)
+                elif isinstance(value, bytes):
+                    future = _done_future(value)
+                else:
+                    future = value
+        pending.append((path, cachekey, rawhash, future))
+
+    def _pop() -> Tuple[str, Optional[bytes]]:
+        path, cachekey, rawhash, future = pending.popleft()
+        hashbytes = _image_result(path, future)
+        if hashbytes is None:
+            if rawhash is not None:
+                decoded.pop(rawhash, None)
+        else:
+            if rawhash is not None:
+                decoded[rawhash] = hashbytes  # don't keep the future alive
+            if cache is not None and cachekey is not None:
+                cache.set(*cachekey, hashbytes)
+        return path, hashbytes
+
+    for path in paths:
+        cachekey: Optional[Tuple[str, int, int]] = None
+        hashbytes: Optional[bytes] = None
+        if cache is not None:
+            stats = os.stat(path)
+            cachekey = (os.path.abspath(path), stats.st_mtime_ns, stats.st_size)
+            hashbytes = cache.get(*cachekey)
+
+        if hashbytes is not None:
+            rawpending.append((path, None, None, _done_future(hashbytes)))
+        elif raw_dedupe and path.lower().endswith(NOMETA_EXTS):
+            rawpending.append((path, cachekey, executor.submit(nometaxxh3, path), None))
+        else:
+            rawpending.append((path, cachekey, None, executor.submit(_phash_image, path)))
+
+        if len(rawpending) >= HASH_PREFETCH:
+            _decode()
+        if len(pending) >= HASH_PREFETCH:
+            yield _pop()
+
+    while rawpending:
+        _decode()
+    while pending:
+        yield _pop()
 
 
 def image_hash_tree(
     dirs: Iterable[PathType],
     exts: Optional[Collection] = None,
-    progressfunc: Optional[Callable[[str, bytes], None]] = None,
-) -> Tuple[BKTree, Dict[bytes, List[str]]]:
-    tree = BKTree(hamming_distance)
-    map: DefaultDict[bytes, List[str]] = defaultdict(list)
+    progressfunc: Optional[Callable[[str, Optional[bytes]], None]] = None,
+    cache: Optional[HashCache] = None,
+    hash_workers: Optional[int] = None,
+    raw_dedupe: bool = False,
+    include_symlinks: bool = False,
+    workers: Optional[int] = None,
+    exclude_names: Collection[str] = frozenset(),
+) -> Tuple[BKTree[int], Dict[int, List[str]]]:
+    """The hashes are stored in the tree and map as ints, so the tree metric doesn't need to convert them
+    on every distance calculation.
+    """
+
+    tree: BKTree[int] = BKTree(hamming_distance)
+    map: DefaultDict[int, List[str]] = defaultdict(list)
     exts = exts or fileextensions.images
 
-    for dir in dirs:
-        for entry in scandir_rec(dir, dirs=True, follow_symlinks=False, allow_skip=True):
-            if entry.is_dir() and entry.name in IGNORE_DIRNAMES:
-                logging.debug("Skipped: %s", entry.path)
-                entry.follow = False
-            elif entry.is_file():
-                ext = entrysuffix(entry)[1:].lower()
-
-                if ext in exts:
-                    try:
-                        img = Image.open(entry.path, "r")
-                        img.load()  # force load so OSError can be caught here
-                    except OSError:
-                        logging.warning("Cannot open image: %s", entry.path)
-                    else:
-                        hashbytes = phash_blockmean(img)
-                        tree.add(hashbytes)
-                        map[hashbytes].append(entry.path)
-                    if progressfunc is not None:
-                        progressfunc(entry.path, hashbytes)
+    # the tree structure depends on the insertion order, so the results are added in scan order
+    with ProcessPoolExecutor(hash_workers) as executor:
+        paths = _iter_image_paths(dirs, exts, include_symlinks, workers, exclude_names)
+        for path, hashbytes in _hash_images(paths, executor, cache, raw_dedupe):
+            if hashbytes is not None:
+                hashint = int.from_bytes(hashbytes, "big")
+                tree.add(hashint)
+                map[hashint].append(path)
+            if progressfunc is not None:
+                progressfunc(path, hashbytes)
 
     return tree, map
 
 
-def iter_size_hashes(
-    dups: Mapping[int, Sequence[str]], hashfunc: Callable[[str], bytes]
-) -> Iterator[Tuple[int, Dict[bytes, List[str]]]]:
-    for size, group in dups.items():
-        hashes: DefaultDict[bytes, List[str]] = defaultdict(list)
+def hash_equal_pair(paths: Tuple[str, str], hashcls: Callable[[], Any]) -> Optional[bytes]:
+    """Compares the contents of the two files in `paths`. Returns the `hashcls` digest of the contents
+    if they are equal and None otherwise. Reading stops at the first difference.
+    """
+
+    a, b = paths
+    m = hashcls()
+    with open(a, "rb") as fa, open(b, "rb") as fb:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fa.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fb.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            data = fa.read(PAIR_CHUNK_SIZE)
+            if data != fb.read(PAIR_CHUNK_SIZE):
+                return None
+            if not data:
+                return m.digest()
+            m.update(data)
+
+
+def hash_sample(path: str, hashcls: Callable[[], Any]) -> bytes:
+    """Returns the `hashcls` digest of the first and last `SAMPLE_SIZE` bytes of the file at `path`.
+    For files not larger than `SAMPLE_SIZE` this is the digest of the complete file.
+    """
+
+    m = hashcls()
+    with open(path, "rb") as fr:
+        m.update(fr.read(SAMPLE_SIZE))
+        size = os.fstat(fr.fileno()).st_size
+        if size > SAMPLE_SIZE:
+            fr.seek(max(SAMPLE_SIZE, size - SAMPLE_SIZE))
+            m.update(fr.read(SAMPLE_SIZE))
+    return m.digest()
+
+
+def _hash_result(path: Any, future: "Future[T]") -> Optional[T]:
+    try:
+        return future.result()
+    except PermissionError:
+        logging.warning("Permission denied: %s", path)
+    except FileNotFoundError:
+        logging.warning("File not found: %s", path)
+    except Skip:
+        pass
+    return None
+
+
+def _hash_paths(
+    items: Iterable[Tuple[int, T]], hashfunc: Callable[[T], Optional[bytes]], executor: Executor
+) -> Iterator[Tuple[int, T, Optional[bytes]]]:
+    """Hashes the paths of `(size, path)` items using `executor` and yields `(size, path, hash)` in input order.
+    At most `HASH_PREFETCH` files are submitted ahead. `hash` is None for files which could not be hashed.
+    """
+
+    pending: Deque[Tuple[int, T, "Future[Optional[bytes]]"]] = deque()
+    for size, path in items:
+        pending.append((size, path, executor.submit(hashfunc, path)))
+        if len(pending) >= HASH_PREFETCH:
+            size, path, future = pending.popleft()
+            yield size, path, _hash_result(path, future)
+
+    for size, path, future in pending:
+        yield size, path, _hash_result(path, future)
+
+
+def _filter_exts(items: Iterable[Tuple[int, str]], exts: Tuple[str, ...]) -> Iterator[Tuple[int, str]]:
+    """Drops files whose hash function would only raise `Skip`, before they are submitted for hashing."""
+
+    for size, path in items:
+        if path.lower().endswith(exts):
+            yield size, path
+
+
+def _skip_empty(
+    items: Iterable[Tuple[int, str]], emptyhash: bytes, dups: DefaultDict[Tuple[int, bytes], List[str]]
+) -> Iterator[Tuple[int, str]]:
+    """Adds empty files to `dups` directly, since their hash is known without reading them,
+    and yields all other `(size, path)` items.
+    """
+
+    for size, path in items:
+        if size == 0:
+            dups[(0, emptyhash)].append(path)
+        else:
+            yield size, path
 
-        for path in group:
-            try:
-                hashbytes = hashfunc(path)
-            except PermissionError:
-                logging.warning("Permission denied: %s", path)
-            except FileNotFoundError:
-                logging.warning("File not found: %s", path)
-            else:
-                hashes[hashbytes].append(path)
 
-        yield size, hashes
+def _size_candidates(
+    items: Iterable[Tuple[int, str]], held: Dict[int, Optional[List[str]]], hold: int = 1
+) -> Iterator[Tuple[int, str]]:
+    """Yields the `(size, path)` items which share their size with more than `hold` other items.
+    The first `hold` paths of every size are held back in `held` until enough are found,
+    afterwards it is set to None.
+    """
+
+    for size, path in items:
+        try:
+            paths = held[size]
+        except KeyError:
+            held[size] = [path]
+            continue
+
+        if paths is None:
+            yield size, path
+        elif len(paths) < hold:
+            paths.append(path)
+        else:
+            held[size] = None
+            for first in paths:
+                yield size, first
+            yield size, path
+
+
+def _cached_candidates(
+    items: Iterable[Tuple[int, str]],
+    cache: HashCache,
+    dups: DefaultDict[Tuple[int, bytes], List[str]],
+    misses: Dict[str, int],
+    hit_sizes: Optional[Set[int]] = None,
+) -> Iterator[Tuple[int, str]]:
+    """Adds the `(size, path)` items whose hash is found in `cache` to `dups` directly and yields the others.
+    The modification times of the yielded items are stored in `misses`, so their hashes can be cached later.
+    The sizes of the items found in `cache` are added to `hit_sizes`.
+    """
+
+    for size, path in items:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            yield size, path  # errors are reported when hashing
+            continue
+
+        hashbytes = cache.get(os.path.abspath(path), mtime, size)
+        if hashbytes is None:
+            misses[path] = mtime
+            yield size, path
+        else:
+            dups[(size, hashbytes)].append(path)
+            if hit_sizes is not None:
+                hit_sizes.add(size)
+
+
+def _cached_pairs(
+    pairs: Iterable[Tuple[int, Tuple[str, str]]],
+    cache: HashCache,
+    dups: DefaultDict[Tuple[int, bytes], List[str]],
+    misses: Dict[str, int],
+) -> Iterator[Tuple[int, Tuple[str, str]]]:
+    """Yields the `(size, (a, b))` pairs which still have to be compared.
+    Pairs where both hashes are found in `cache` are not yielded, but added to `dups` if the hashes are equal.
+    """
+
+    for size, pair in pairs:
+        pairdups: DefaultDict[Tuple[int, bytes], List[str]] = defaultdict(list)
+        uncached = list(_cached_candidates([(size, path) for path in pair], cache, pairdups, misses))
+        if uncached:
+            yield size, pair
+        else:
+            for key, paths in pairdups.items():
+                dups[key].extend(paths)
+
+
+def _cache_hash(cache: HashCache, misses: Dict[str, int], size: int, path: str, hashbytes: bytes) -> None:
+    try:
+        mtime = misses.pop(path)
+    except KeyError:
+        return
+    cache.set(os.path.abspath(path), mtime, size, hashbytes)
+
+
+def _sample_candidates(
+    items: Iterable[Tuple[int, str]],
+    samplefunc: Callable[[str], bytes],
+    executor: Executor,
+    dups: DefaultDict[Tuple[int, bytes], List[str]],
+    cache: Optional[HashCache] = None,
+    misses: Optional[Dict[str, int]] = None,
+    hit_sizes: Optional[Set[int]] = None,
+) -> Iterator[Tuple[int, str]]:
+    """Yields the `(size, path)` items which share their size and sample hash with another item.
+    The sample hash of files not larger than `SAMPLE_SIZE` is their complete hash,
+    so they are added to `dups` (and `cache`) directly instead.
+    Items with a size in `hit_sizes` can still match a cached file which was never sampled,
+    so they are yielded at the end even if they don't share their sample hash.
+    """
+
+    firsts: Dict[Tuple[int, bytes], Optional[str]] = {}
+
+    for size, path, sample in _hash_paths(items, samplefunc, executor):
+        if sample is None:
+            continue
+
+        if size <= SAMPLE_SIZE:
+            dups[(size, sample)].append(path)
+            if cache is not None and misses is not None:
+                _cache_hash(cache, misses, size, path, sample)
+            continue
+
+        key = (size, sample)
+        try:
+            first = firsts[key]
+        except KeyError:
+            firsts[key] = path
+            continue
+
+        if first is not None:
+            firsts[key] = None
+            yield size, first
+        yield size, path
+
+    # `hit_sizes` is only complete after all items are consumed
+    if hit_sizes:
+        for (size, _sample), first in firsts.items():
+            if first is not None and size in hit_sizes:
+                yield size, first
 
 
 def write_dupegroups_dupeguru(outpath: Path, pathgroups: Iterable[Sequence[str]]):
+    """Writes the groups one by one, so only a single group is kept in memory at a time."""
+
     from xml.etree import ElementTree as ET
 
-    root = ET.Element("results")
-    root.text = "\n"
-    root.tail = "\n"
+    with open(outpath, "w", encoding="utf-8", errors="xmlcharrefreplace") as fw:
+        fw.write("<results>\n")
 
-    for paths in pathgroups:
-        group = ET.SubElement(root, "group")
-        group.text = "\n"
-        group.tail = "\n"
+        for paths in pathgroups:
+            fw.write("<group>\n")
 
-        for filepath in paths:
-            element = ET.SubElement(group, "file", path=filepath, words="", is_ref="n", marked="n")
-            element.tail = "\n"
+            for filepath in paths:
+                element = ET.Element("file", path=filepath, words="", is_ref="n", marked="n")
+                element.tail = "\n"
+                fw.write(ET.tostring(element, encoding="unicode"))
 
-        for i, j in combinations(range(len(paths)), 2):
-            element = ET.SubElement(group, "match", first=str(i), second=str(j), percentage="100")
-            element.tail = "\n"
+            # match elements only contain indices, so they don't need to go through ElementTree
+            indices = [str(i) for i in range(len(paths))]
+            fw.writelines(f'<match first="{i}" second="{j}" percentage="100" />\n' for i, j in combinations(indices, 2))
 
-    tree = ET.ElementTree(root)
-    tree.write(outpath, encoding="utf-8")
+            fw.write("</group>\n")
+
+        fw.write("</results>\n")
 
 
 def dupegroups(
-    dirs: Iterable[PathType], hashfunc: Callable[[str], bytes], progress: Progress, include_symlinks: bool
+    dirs: Iterable[PathType],
+    hashfunc: Callable[[str], bytes],
+    progress: Progress,
+    include_symlinks: bool,
+    workers: Optional[int] = None,
+    hash_workers: Optional[int] = None,
+    hashcls: Optional[Callable[[], Any]] = None,
+    cache: Optional[HashCache] = None,
+    exclude_names: Collection[str] = frozenset(),
+    exts: Optional[Tuple[str, ...]] = None,
 ) -> Dict[Tuple[int, bytes], List[str]]:
-    dups = defaultdict(list)
-
-    total = 0
-    for size, path in progress.track(iter_size_path(dirs, include_symlinks), description="Collecting files..."):
-        dups[size].append(path)
-        total += 1
-    logging.info("Found %s size groups in %d files", len(dups), total)
-
-    logging.info("Filtering files based on size")
-    dups = {k: v for k, v in dups.items() if len(v) > 1}
-    logging.info("Found %s duplicate size groups", len(dups))
+    """If `hashcls` is given, it must produce the same digests as `hashfunc`. Size groups of exactly
+    two files are then compared directly instead of being hashed separately, and larger groups are
+    split by the hash of the first and last `SAMPLE_SIZE` bytes before the files are hashed completely.
+    Files with a hash in `cache` and empty files (if `hashcls` is given) are not read at all.
+    If `exts` is given, only files with one of these lowercase extensions are considered.
+    """
+
+    held: Dict[int, Optional[List[str]]] = {}
+    dups: DefaultDict[Tuple[int, bytes], List[str]] = defaultdict(list)
+    misses: Dict[str, int] = {}
+    hit_sizes: Set[int] = set()
+    hold = 1 if hashcls is None else 2
+
+    # files are hashed as soon as enough files of the same size are found, while the scan continues
+    logging.info("Collecting files and calculating hash groups")
+    # hashlib and xxhash release the GIL while hashing and reading files, so threads are enough
+    with ThreadPoolExecutor(hash_workers) as executor:
+        items = progress.track(
+            iter_size_path(dirs, include_symlinks, workers, exclude_names), description="Collecting files..."
+        )
+        if exts is not None:
+            items = _filter_exts(items, exts)
+        if hashcls is not None:
+            items = _skip_empty(items, hashcls().digest(), dups)
+        candidates = _size_candidates(items, held, hold)
+        if cache is not None:
+            candidates = _cached_candidates(candidates, cache, dups, misses, hit_sizes)
+        if hashcls is not None:
+            samplefunc = partial(hash_sample, hashcls=hashcls)
+            candidates = _sample_candidates(candidates, samplefunc, executor, dups, cache, misses, hit_sizes)
+
+        for size, path, hashbytes in _hash_paths(candidates, hashfunc, executor):
+            if hashbytes is not None:
+                dups[(size, hashbytes)].append(path)
+                if cache is not None:
+                    _cache_hash(cache, misses, size, path, hashbytes)
+
+        if hashcls is not None:
+            pairs: Iterable[Tuple[int, Tuple[str, str]]] = (
+                (size, (paths[0], paths[1])) for size, paths in held.items() if paths and len(paths) == 2
+            )
+            if cache is not None:
+                pairs = _cached_pairs(pairs, cache, dups, misses)
+            func = partial(hash_equal_pair, hashcls=hashcls)
+            for size, pair, hashbytes in progress.track(
+                _hash_paths(pairs, func, executor), description="Comparing pairs..."
+            ):
+                if hashbytes is not None:
+                    dups[(size, hashbytes)].extend(pair)
+                    if cache is not None:
+                        for path in pair:
+                            _cache_hash(cache, misses, size, path, hashbytes)
 
-    logging.info("Calculating hash groups")
-    for size, hashes in progress.track(iter_size_hashes(dups, hashfunc), total=len(dups)):
-        dups[size] = hashes
+    logging.info("Found %s size groups", len(held))
+    logging.info("Found %s duplicate size groups", sum(1 for paths in held.values() if paths is None or len(paths) > 1))
 
     logging.info("Filtering files based on hashes")
-    newdups: Dict[Tuple[int, bytes], List[str]] = {}
-    for size, sizegroup in dups.items():
-        for hashbytes, hashgroup in sizegroup.items():
-            if len(hashgroup) > 1:
-                newdups[(size, hashbytes)] = hashgroup
-
-    return newdups
+    return {key: hashgroup for key, hashgroup in dups.items() if len(hashgroup) > 1}
 
 
 def dupegroups_no_size(
-    dirs: Iterable[PathType], hashfunc: Callable[[str], bytes], progress: Progress, include_symlinks: bool = False
+    dirs: Iterable[PathType],
+    hashfunc: Callable[[str], bytes],
+    progress: Progress,
+    include_symlinks: bool = False,
+    workers: Optional[int] = None,
+    hash_workers: Optional[int] = None,
+    exclude_names: Collection[str] = frozenset(),
+    exts: Optional[Tuple[str, ...]] = None,
 ) -> Dict[bytes, List[Tuple[str, int]]]:
     dups = defaultdict(list)
 
     total = 0
-    for size, path in progress.track(iter_size_path(dirs, include_symlinks), description="Calculating hash groups..."):
-        total += 1
-        try:
-            hash = hashfunc(path)
-        except PermissionError:
-            logging.warning("Permission denied: %s", path)
-        except FileNotFoundError:
-            logging.warning("File not found: %s", path)
-        except Skip:
-            pass
-        else:
-            dups[hash].append((path, size))
+    with ThreadPoolExecutor(hash_workers) as executor:
+        items = iter_size_path(dirs, include_symlinks, workers, exclude_names)
+        if exts is not None:
+            items = _filter_exts(items, exts)
+        for size, path, hash in progress.track(
+            _hash_paths(items, hashfunc, executor), description="Calculating hash groups..."
+        ):
+            total += 1
+            if hash is not None:
+                dups[hash].append((path, size))
 
     logging.info("Found %s hash groupsin %d files", len(dups), total)
 
@@ -219,7 +794,14 @@ if __name__ == "__main__":
     from genutility.args import is_dir
     from genutility.file import StdoutFile
 
-    hashfuncs = {"metrohash": metrohash, "no-meta-sha1": nometahash}
+    hashfuncs = {"xxh3": xxh3, "metrohash": metrohash, "no-meta-sha1": nometahash, "no-meta-xxh3": nometaxxh3}
+    # hash classes which produce the same digests as the hash functions above
+    hashclss = {"xxh3": xxh3_128, "metrohash": MetroHash128}
+    # file extensions supported by the hash functions above, all other files are skipped
+    hashexts = {"no-meta-sha1": NOMETA_EXTS, "no-meta-xxh3": NOMETA_EXTS}
+    DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+    DEFAULT_HASH_WORKERS = min(61, os.cpu_count() or 1)  # ProcessPoolExecutor supports at most 61 on Windows
+    DEFAULT_REGEX = ("^(.*)$", r"\1")
 
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
     parser.add_argument("directories", type=is_dir, nargs="+", help="Directory to search")
@@ -231,6 +813,20 @@ if __name__ == "__main__":
         help="Optional output file path. If not given it will be printed to stdout.",
     )
     parser.add_argument("-v", "--verbose", action="store_true", help="Print debug information")
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of concurrent threads used to scan directories",
+    )
+    parser.add_argument(
+        "--hash-workers",
+        metavar="N",
+        type=int,
+        default=DEFAULT_HASH_WORKERS,
+        help="Number of threads used to hash files for --exact and processes used to hash images for --images",
+    )
     parser.add_argument(
         "--no-size", action="store_true", help="Hash files without excluding matches by size first. Don't use."
     )
@@ -239,15 +835,33 @@ if __name__ == "__main__":
         action="store_true",
         help="DANGER! Include symlinks in the analysis. This will return duplicate groups even if there is only one actual file in the group. Deleting the wrong file will remove the whole group.",
     )
-    parser.add_argument("--hashfunc", default="metrohash", choices=hashfuncs.keys(), help="Hash function")
+    parser.add_argument(
+        "--exclude-name",
+        metavar="NAME",
+        action="append",
+        default=[],
+        help="Skip files and directories with this exact name, e.g. Thumbs.db. Can be given multiple times.",
+    )
+    parser.add_argument("--hashfunc", default="xxh3", choices=hashfuncs.keys(), help="Hash function")
     parser.add_argument(
         "--dupeguru", metavar="PATH", type=Path, help="Output the results in Dupeguru format to this path."
     )
+    parser.add_argument(
+        "--cache",
+        metavar="PATH",
+        type=Path,
+        help="Cache file and image hashes in this sqlite database, so unchanged files are not read again on later runs.",
+    )
+    parser.add_argument(
+        "--raw-dedupe",
+        action="store_true",
+        help="For --images: hash the raw image data of JPEG and PNG files first and decode only one image of each set of files with identical image data.",
+    )
     parser.add_argument(
         "--regex",
         nargs=2,
         metavar=("PATTERN", "REPL"),
-        default=("^(.*)$", r"\1"),
+        default=DEFAULT_REGEX,
         help="Extract key to group by from filename.",
     )
 
@@ -264,6 +878,14 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
+    exclude_names = frozenset(args.exclude_name)
+
+    if args.cache and args.exact and args.no_size:
+        parser.error("--cache cannot be used with --no-size")
+    if args.cache and args.filename:
+        parser.error("--cache cannot be used with --filename")
+    if args.raw_dedupe and not args.images:
+        parser.error("--raw-dedupe can only be used with --images")
 
     handler = RichHandler(log_time_format="%Y-%m-%d %H-%M-%S%Z", highlighter=NullHighlighter())
     FORMAT = "%(message)s"
@@ -286,7 +908,16 @@ if __name__ == "__main__":
             hashfunc = hashfuncs[args.hashfunc]
 
             if args.no_size:
-                groups = dupegroups_no_size(args.directories, hashfunc, p, args.include_symlinks)
+                groups = dupegroups_no_size(
+                    args.directories,
+                    hashfunc,
+                    p,
+                    args.include_symlinks,
+                    args.workers,
+                    args.hash_workers,
+                    exclude_names,
+                    hashexts.get(args.hashfunc),
+                )
 
                 if args.dupeguru:
                     pathgroups = ([path for path, size in paths_sizes] for paths_sizes in groups.values())
@@ -296,11 +927,23 @@ if __name__ == "__main__":
                     csvwriter = csv.writer(csvfile)
                     csvwriter.writerow(["hash", "path", "size"])
                     for hashbytes, paths_sizes in groups.items():
-                        for path, size in paths_sizes:
-                            csvwriter.writerow([hashbytes.hex(), path, size])
+                        hashhex = hashbytes.hex()
+                        csvwriter.writerows([hashhex, path, size] for path, size in paths_sizes)
 
             else:
-                groups = dupegroups(args.directories, hashfunc, p, args.include_symlinks)
+                with open_cache(args.cache, args.hashfunc) as cache:
+                    groups = dupegroups(
+                        args.directories,
+                        hashfunc,
+                        p,
+                        args.include_symlinks,
+                        args.workers,
+                        args.hash_workers,
+                        hashclss.get(args.hashfunc),
+                        cache,
+                        exclude_names,
+                        hashexts.get(args.hashfunc),
+                    )
 
                 if args.dupeguru:
                     write_dupegroups_dupeguru(args.dupeguru, groups.values())
@@ -309,8 +952,8 @@ if __name__ == "__main__":
                     csvwriter = csv.writer(csvfile)
                     csvwriter.writerow(["size", "hash", "path"])
                     for (size, hashbytes), paths in groups.items():
-                        for path in paths:
-                            csvwriter.writerow([size, hashbytes.hex(), path])
+                        hashhex = hashbytes.hex()
+                        csvwriter.writerows([size, hashhex, path] for path in paths)
 
         elif args.images:
             if args.dupeguru:
@@ -318,21 +961,33 @@ if __name__ == "__main__":
 
             with StdoutFile(args.out, "xt", encoding="utf-8") as fw:
                 with p.task(description="Hashing images...") as task:
-                    tree, map = image_hash_tree(args.directories, progressfunc=lambda _path, _hash: task.advance(1))
-
-                for d in range(100):
-                    groups = []
-
-                    for hashgroup in tree.find_by_distance(d):
-                        files = []
-                        for hashbytes in hashgroup:
-                            files.extend(map[hashbytes])
-                        groups.append(files)
-
-                    if groups:
+                    with open_cache(args.cache, PHASH_CACHE_NAME) as cache:
+                        tree, map = image_hash_tree(
+                            args.directories,
+                            progressfunc=lambda _path, _hash: task.advance(1),
+                            cache=cache,
+                            hash_workers=args.hash_workers,
+                            raw_dedupe=args.raw_dedupe,
+                            include_symlinks=args.include_symlinks,
+                            workers=args.workers,
+                            exclude_names=exclude_names,
+                        )
+
+                max_distance = 100
+                distance_groups = groups_by_distance(tree, max_distance)
+                for d in range(max_distance):
+                    image_groups: List[List[str]] = []
+
+                    for hashgroup in distance_groups.get(d, []):
+                        files: List[str] = []
+                        for hashint in hashgroup:
+                            files.extend(map[hashint])
+                        image_groups.append(files)
+
+                    if image_groups:
                         fw.write(f"Distance: {d}\n")
-                        for hashgroup in groups:
-                            fw.write(f"{hashgroup}\n")
+                        for files in image_groups:
+                            fw.write(f"{files}\n")
 
                         fw.write("---\n")
 
@@ -344,17 +999,25 @@ if __name__ == "__main__":
 
             pattern_, repl = args.regex
             pattern = re.compile(pattern_)
+            # the default pattern maps every filename without a newline to itself
+            identity = tuple(args.regex) == DEFAULT_REGEX
 
             logging.info("Using pattern `%s` with replacement `%s`", pattern.pattern, repl)
 
             total = 0
             for size, path in p.track(
-                iter_size_path(args.directories, args.include_symlinks), description="Collecting files..."
+                iter_size_path(args.directories, args.include_symlinks, args.workers, exclude_names),
+                description="Collecting files...",
             ):
-                key, nsubs = pattern.subn(repl, Path(path).name)
-                if nsubs > 0:
-                    dups[key].append((path, size))
-                    total += 1
+                name = os.path.basename(path)
+                if identity and "\n" not in name:
+                    key = name
+                else:
+                    key, nsubs = pattern.subn(repl, name)
+                    if nsubs == 0:
+                        continue
+                dups[key].append((path, size))
+                total += 1
             logging.info("Found %s groups in %d files", len(dups), total)
 
             dups = {k: v for k, v in dups.items() if len(v) > 1}
@@ -368,5 +1031,4 @@ if __name__ == "__main__":
                 csvwriter = csv.writer(csvfile)
                 csvwriter.writerow(["key", "path", "size"])
                 for key, paths_sizes in dups.items():
-                    for path, size in paths_sizes:
-                        csvwriter.writerow([key, path, size])
+                    csvwriter.writerows([key, path, size] for path, size in paths_sizes)
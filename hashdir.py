@@ -1,17 +1,34 @@
 import hashlib
 import logging
 import os.path
-import re
 import sys
+import threading
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from os import fspath
 from pathlib import Path
-from typing import IO, Iterable, Iterator, List, Optional, Sequence, Type, TypedDict
+from typing import (
+    IO,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    TypedDict,
+    cast,
+)
 
 from genutility.callbacks import Progress as NullProgress
 from genutility.file import StdoutFile
-from genutility.filesystem import PathType, filter_recall, scandir_error_log_warning, scandir_rec
-from genutility.hash import HashCls, Hashobj, HashobjCRC, hash_file
+from genutility.filesystem import MyDirEntry, PathType, filter_recall, scandir_error_log_warning, scandir_rec
+from genutility.hash import HashCls, Hashobj, HashobjCRC
 from genutility.iter import CachedIterable
 from genutility.rich import MarkdownHighlighter, Progress, StdoutFileNoStyle
 from rich.logging import RichHandler
@@ -22,12 +39,32 @@ from typing_extensions import NotRequired, Self
 
 logger = logging.getLogger(__name__)
 
+HASH_PREFETCH = 256  # maximum number of files submitted for hashing ahead of the one being output
+HASH_BUFFER_SIZE = 1024 * 1024
+
+_local = threading.local()
+
+
+def _posix_basename(path: str) -> str:
+    # same as `posixpath.basename` for str paths, without its fspath and separator type checks
+    return path.rpartition("/")[2]
+
+
+# `ntpath.basename` also splits on backslashes, which can occur in paths read from files
+_basename = cast(Callable[[str], str], os.path.basename) if os.name == "nt" else _posix_basename
+
 
 class Meta(TypedDict):
     hash: Optional[bytes]
     size: NotRequired[int]
 
 
+class FileInfo(NamedTuple):
+    path: str
+    size: int
+    location: Tuple[int, int]  # (st_dev, st_ino)
+
+
 def get_hash_name(hashcls: HashCls) -> str:
     if isinstance(hashcls, str):
         return hashcls
@@ -37,11 +74,101 @@ def get_hash_name(hashcls: HashCls) -> str:
         raise TypeError(type(hashcls))
 
 
-def _metas(paths: List[str], hashcls: HashCls, dirpath: PathType) -> Iterator[Meta]:
-    for path in paths:
-        abspath = os.path.join(dirpath, path)
+def _new_hashobj(hashcls: HashCls) -> Hashobj:
+    if isinstance(hashcls, str):
+        return hashlib.new(hashcls)
+    else:
+        return hashcls()
+
+
+def _hash_file(abspath: str, hashcls: HashCls) -> bytes:
+    """Like `genutility.hash.hash_file`, but reads into a buffer which is reused by the calling thread
+    instead of allocating a new bytes object for every chunk.
+    """
+
+    m = _new_hashobj(hashcls)
+
+    try:
+        buffer = _local.buffer
+    except AttributeError:
+        buffer = _local.buffer = bytearray(HASH_BUFFER_SIZE)
+
+    view = memoryview(buffer)
+    with open(abspath, "rb", buffering=0) as fr:
+        if hasattr(os, "posix_fadvise"):  # larger readahead, files are read once from start to end
+            os.posix_fadvise(fr.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = fr.readinto(buffer)
+            if not n:
+                break
+            m.update(view[:n])
+
+    return m.digest()
+
+
+def _meta_result(path: str, size: int, future: "Future[bytes]") -> Meta:
+    try:
+        hashbytes: Optional[bytes] = future.result()
+    except OSError as e:
+        if e.filename:
+            logger.error("Failed to hash file: %s", e)
+        else:
+            logger.error("Failed to hash `%s`: %s", path, e)
+        hashbytes = None
+    return {"hash": hashbytes, "size": size}
+
+
+def _metas(
+    infos: List[FileInfo], hashcls: HashCls, dirpath: PathType, workers: Optional[int] = None, io_order: str = "name"
+) -> Iterator[Meta]:
+    """Files are hashed in parallel by `workers` threads, but the metas are always yielded in the order of `infos`.
+    Threads are sufficient, since reading files as well as hashlib and zlib release the GIL for large buffers.
+
+    `io_order`: "name" reads the files in the order of `infos`.
+        "inode" reads them in inode order, which approximates their on-disk order on most POSIX filesystems
+        and reduces seeking on hard disks. All files are submitted at once in this case.
+    """
+
+    with ThreadPoolExecutor(workers) as executor:
+        if io_order == "name":
+            pending: Deque[Tuple[str, int, "Future[bytes]"]] = deque()
+
+            for path, size, _ in infos:
+                abspath = os.path.join(dirpath, path)
+                pending.append((path, size, executor.submit(_hash_file, abspath, hashcls)))
+                if len(pending) >= HASH_PREFETCH:
+                    yield _meta_result(*pending.popleft())
+
+            while pending:
+                yield _meta_result(*pending.popleft())
+
+        elif io_order == "inode":
+            futures: Dict[int, "Future[bytes]"] = {}
+            try:
+                for i in sorted(range(len(infos)), key=lambda i: infos[i].location):
+                    futures[i] = executor.submit(_hash_file, os.path.join(dirpath, infos[i].path), hashcls)
+
+                for i, (path, size, _) in enumerate(infos):
+                    yield _meta_result(path, size, futures.pop(i))
+            finally:
+                for future in futures.values():  # don't hash the remaining files if the generator is closed early
+                    future.cancel()
+
+        else:
+            raise ValueError(f"Invalid io_order: {io_order}")
+
+
+def _file_infos(entries: Iterable[MyDirEntry]) -> Iterator[FileInfo]:
+    for entry in entries:
+        if os.name == "nt":
+            path = entry.relpath.replace("\\", "/")
+        else:
+            path = entry.relpath
+
+        # the stats are cached by the entry. on Windows they come from the directory listing without a syscall,
+        # but `st_ino` is 0 then, so the inode order is the same as the name order.
         try:
-            size = os.path.getsize(abspath)
+            stats = entry.stat()
         except FileNotFoundError:
             logger.warning("File disappeared: `%s`", path)
             continue
@@ -52,35 +179,27 @@ def _metas(paths: List[str], hashcls: HashCls, dirpath: PathType) -> Iterator[Me
                 logger.error("Failed to read size of `%s`: %s", path, e)
             continue
 
-        try:
-            hashbytes = hash_file(abspath, hashcls).digest()
-        except OSError as e:
-            if e.filename:
-                logger.error("Failed to hash file: %s", e)
-            else:
-                logger.error("Failed to hash `%s`: %s", path, e)
-            hashbytes = None
-        yield {"hash": hashbytes, "size": size}
+        yield FileInfo(path, stats.st_size, (stats.st_dev, stats.st_ino))
 
 
-def _paths(dirpath: PathType, recall: bool, progress: Optional[NullProgress] = None) -> List[str]:
-    def sortkey(relpath: str) -> List[str]:
-        return relpath.split("/")
+def _paths(dirpath: PathType, recall: bool, progress: Optional[NullProgress] = None) -> List[FileInfo]:
+    """Returns the relative paths, sizes and locations of all files in `dirpath`, sorted by path."""
+
+    def sortkey(info: FileInfo) -> str:
+        # same order as comparing `path.split("/")`, since paths cannot contain NUL characters.
+        # but comparing single strings is much faster than comparing lists of strings.
+        return info.path.replace("/", "\0")
 
     it = filter(
         filter_recall(recall),
         scandir_rec(dirpath, files=True, dirs=False, relative=True, errorfunc=scandir_error_log_warning),
     )
-
-    if os.name == "nt":
-        normit = (entry.relpath.replace("\\", "/") for entry in it)
-    else:
-        normit = (entry.relpath for entry in it)
+    infoit = _file_infos(it)
 
     if progress is None:
-        return sorted(normit, key=sortkey)
+        return sorted(infoit, key=sortkey)
     else:
-        return sorted(progress.track(normit), key=sortkey)
+        return sorted(progress.track(infoit), key=sortkey)
 
 
 class Formatter:
@@ -156,12 +275,21 @@ class DirHasher:
 
     @classmethod
     def from_fs(
-        cls, dirpath: PathType, recall: bool, hashcls: HashCls = hashlib.sha1, progress: Optional[NullProgress] = None
+        cls,
+        dirpath: PathType,
+        recall: bool,
+        hashcls: HashCls = hashlib.sha1,
+        progress: Optional[NullProgress] = None,
+        workers: Optional[int] = None,
+        io_order: str = "name",
     ) -> Self:
-        """Creates a DirHasher instance for a filesystem folder."""
+        """Creates a DirHasher instance for a filesystem folder.
+        The files are hashed lazily by `workers` threads in `io_order`, see `_metas`.
+        """
 
-        paths = _paths(dirpath, recall, progress)
-        metas = _metas(paths, hashcls, dirpath)
+        infos = _paths(dirpath, recall, progress)
+        paths = [info.path for info in infos]
+        metas = _metas(infos, hashcls, dirpath, workers, io_order)
 
         return cls(paths, CachedIterable(metas), get_hash_name(hashcls), fspath(dirpath), progress)
 
@@ -183,13 +311,19 @@ class DirHasher:
 
         with open(filepath, encoding="utf-8") as fr:
             for i, line in enumerate(fr, 1):
-                m = re.match(r"^([0-9a-fA-F]+) [ \*](.*)$", line.rstrip())
-                if not m:
+                # lines look like `<hex digest> *<path>` or `<hex digest>  <path>`
+                hashhex, _, rest = line.rstrip().partition(" ")
+                try:
+                    hashbytes = bytes.fromhex(hashhex)
+                except ValueError:
+                    hashbytes = b""
+
+                # `bytes.fromhex` skips whitespace, so the length check makes sure all characters were hex digits
+                if not hashbytes or len(hashbytes) * 2 != len(hashhex) or rest[:1] not in (" ", "*"):
                     msg = f"Invalid file (error in line {i}"
                     raise ValueError(msg)
 
-                hashhex, path = m.groups()
-                hashbytes = bytes(bytearray.fromhex(hashhex))
+                path = rest[1:]
                 metas.append({"hash": hashbytes})
                 paths.append(path)
 
@@ -208,14 +342,25 @@ class DirHasher:
         formatter = self.get_formatter_class(fformat)(stream)
         formatter.header(self.hashname)
 
+        # the total is calculated in the same pass, see `total_line`
+        m = _new_hashobj(hashcls)
+        total_size = 0
+
         for meta, path in self.progress.track(zip(self.metas, self.paths), total=len(self.paths)):
-            if meta["hash"] is None:  # reading file might have failed during hash calculation
+            total_size += meta["size"]
+            hashbytes = meta["hash"]
+            if hashbytes is None:  # reading file might have failed during hash calculation
                 continue
 
-            formatter.format_line(meta["hash"].hex(), path, meta["size"])
+            formatter.format_line(hashbytes.hex(), path, meta["size"])
+
+            if include_total:
+                if include_names:
+                    m.update(_basename(path).encode("utf-8"))
+                m.update(hashbytes)
 
         if include_total:
-            self.total_line(formatter, hashcls, include_names)
+            formatter.format_total(m.hexdigest(), self.toppath, total_size)
 
     def total_line(
         self,
@@ -228,17 +373,14 @@ class DirHasher:
         formatter.format_total(total_hexdigest, self.toppath, total_size)
 
     def total(self, hashcls: HashCls = hashlib.sha1, include_names: bool = True) -> Hashobj:
-        if isinstance(hashcls, str):
-            m = hashlib.new(hashcls)
-        else:
-            m = hashcls()
+        m = _new_hashobj(hashcls)
 
         for meta, path in zip(self.metas, self.paths):
             if meta["hash"] is None:
                 continue
 
             if include_names:
-                m.update(os.path.basename(path).encode("utf-8"))
+                m.update(_basename(path).encode("utf-8"))
             m.update(meta["hash"])
 
         return m
@@ -290,7 +432,7 @@ def main(args: Namespace) -> int:
                 writer = StdoutFile(args.out, "xt", encoding="utf-8")
 
             with writer as fw:
-                hasher = DirHasher.from_fs(args.path, args.recall, algorithm, progress)
+                hasher = DirHasher.from_fs(args.path, args.recall, algorithm, progress, args.workers, args.io_order)
                 hasher.to_stream(fw, include_total=True, fformat=args.format, include_names=not args.no_names)
 
     elif args.input == "file":
@@ -308,6 +450,7 @@ if __name__ == "__main__":
     ALGORITHMS = sorted(hashlib.algorithms_available) + ["crc32"]
     HASHDEEP_ALGOS = sorted({"md5", "sha1", "sha256", "whirlpool", "tiger"} & set(ALGORITHMS))
     DEFAULT_ALGO = "sha1"
+    DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
 
     parser = ArgumentParser(
         description="calculate hash of all files in directory combined", formatter_class=ArgumentDefaultsHelpFormatter
@@ -330,6 +473,19 @@ if __name__ == "__main__":
     parser.add_argument(
         "--algorithm", choices=ALGORITHMS, default=DEFAULT_ALGO, help="Hashing algorithm for file contents."
     )
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of threads used to read and hash files",
+    )
+    parser.add_argument(
+        "--io-order",
+        choices=("name", "inode"),
+        default="name",
+        help="Order in which files are read. inode can reduce seeking on hard disks. The output is always sorted by name.",
+    )
     parser.add_argument("--no-names", action="store_true", help="Don't include filenames in summary hash calculation")
     parser.add_argument(
         "--recall",
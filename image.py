@@ -39,7 +39,9 @@ def process(args: Namespace) -> None:
             new_size = (int(img.size[0] * args.resize_ratio[0]), int(img.size[1] * args.resize_ratio[1]))
         elif args.resize_pixel:
             new_size = args.resize_pixel
-        img = img.resize(new_size, resample=Image.Resampling.LANCZOS)
+        # `reducing_gap` first reduces large images by an integer factor with a cheap box filter,
+        # the result is practically the same as resampling the full image
+        img = img.resize(new_size, resample=Image.Resampling.LANCZOS, reducing_gap=3.0)
 
     logging.debug("Saving image to <%s>", args.out_path)
     img.save(args.out_path)
@@ -1,15 +1,104 @@
+import hashlib
 import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import partial
+from io import FileIO
 from math import ceil, log2
 from os import fspath
 from pathlib import Path
-from typing import Callable, Iterable, Optional
+from typing import Callable, Deque, Iterable, Iterator, Optional, Tuple
 
 import libtorrent
 
 logger = logging.getLogger(__name__)
 
 
+def _readinto_exactly(fr: FileIO, view: memoryview) -> None:
+    while view:
+        n = fr.readinto(view)
+        if not n:
+            raise EOFError(f"File `{fr.name}` is shorter than when it was added to the torrent")
+        view = view[n:]
+
+
+def _iter_pieces(fs: libtorrent.file_storage, basepath: str) -> Iterator[bytearray]:
+    """Yields the pieces of a v1 torrent, ie. the concatenated file contents split into `piece_length` chunks."""
+
+    piece_length = fs.piece_length()
+    piece = bytearray(piece_length)
+    pos = 0
+
+    for index in range(fs.num_files()):
+        size = fs.file_size(index)
+        if size == 0:
+            continue
+
+        if fs.file_flags(index) & libtorrent.file_storage.flag_pad_file:
+            fr: Optional[FileIO] = None
+        else:
+            fr = open(fs.file_path(index, basepath), "rb", buffering=0)
+            if hasattr(os, "posix_fadvise"):  # larger readahead, files are read once from start to end
+                os.posix_fadvise(fr.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        try:
+            while size > 0:
+                n = min(size, piece_length - pos)
+                view = memoryview(piece)[pos : pos + n]
+                if fr is None:
+                    view[:] = bytes(n)  # pad files are zeros
+                else:
+                    _readinto_exactly(fr, view)
+                pos += n
+                size -= n
+
+                if pos == piece_length:
+                    yield piece
+                    piece = bytearray(piece_length)  # the previous one might still be hashed
+                    pos = 0
+        finally:
+            if fr is not None:
+                fr.close()
+
+    if pos > 0:
+        yield piece[:pos]
+
+
+def _sha1_digest(data: bytearray) -> bytes:
+    return hashlib.sha1(data).digest()
+
+
+def set_piece_hashes_v1(
+    t: libtorrent.create_torrent,
+    basepath: str,
+    workers: Optional[int] = None,
+    progress: Optional[Callable[[int], None]] = None,
+) -> None:
+    """Like `libtorrent.set_piece_hashes`, but the pieces are hashed by `workers` threads instead of a single one.
+    This only works for v1 torrents, since v2 uses per-file merkle trees which cannot be set using the Python bindings.
+    Files are read sequentially and at most `2 * workers` pieces are kept in memory.
+    """
+
+    workers = workers or os.cpu_count() or 1
+    pending: Deque[Tuple[int, "Future[bytes]"]] = deque()
+
+    def set_hash(index: int, future: "Future[bytes]") -> None:
+        t.set_hash(index, future.result())
+        if progress:
+            progress(index)
+
+    # hashlib releases the GIL while hashing, so the pieces are hashed in parallel
+    with ThreadPoolExecutor(workers) as executor:
+        for index, piece in enumerate(_iter_pieces(t.files(), basepath)):
+            pending.append((index, executor.submit(_sha1_digest, piece)))
+            if len(pending) >= 2 * workers:
+                set_hash(*pending.popleft())
+
+        while pending:
+            set_hash(*pending.popleft())
+
+
 def create_torrent(
     path: Path,
     trackers: Iterable[str] = (),
@@ -22,10 +111,12 @@ def create_torrent(
     progress: Optional[Callable[[int, int], None]] = None,
     min_piece_exp: int = 14,
     max_piece_exp: int = 24,
+    workers: Optional[int] = None,
 ) -> bytes:
     """
     min_piece_exp: default 16k
     max_piece_exp: default 16M
+    workers: number of threads used to hash v1-only torrents
     """
 
     if pieces is None and piece_size is None:
@@ -62,7 +153,14 @@ def create_torrent(
         t.set_priv(private)
 
     if progress:
-        libtorrent.set_piece_hashes(t, fspath(path.parent), partial(progress, ceil(fs.total_size() / piece_size)))
+        progressfunc: Optional[Callable[[int], None]] = partial(progress, ceil(fs.total_size() / piece_size))
+    else:
+        progressfunc = None
+
+    if flags & libtorrent.create_torrent.v1_only:
+        set_piece_hashes_v1(t, fspath(path.parent), workers, progressfunc)
+    elif progressfunc:
+        libtorrent.set_piece_hashes(t, fspath(path.parent), progressfunc)
     else:
         libtorrent.set_piece_hashes(t, fspath(path.parent))
 
@@ -104,6 +202,13 @@ if __name__ == "__main__":
         help="Piece size. If not given, it will be automatically calculated to match --pieces.",
     )
     parser.add_argument("--source", default=None, help="Source value of info dict")
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of threads used to hash the pieces of --v1 torrents",
+    )
     args = parser.parse_args()
 
     if args.private and not args.trackers:
@@ -135,6 +240,7 @@ if __name__ == "__main__":
                 flags,
                 predicate=predicate,
                 progress=progressfunc,
+                workers=args.workers,
             )
 
     with open(args.outpath, "wb") as fw:
@@ -1,72 +1,106 @@
 import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from shutil import copystat
+from typing import List, Optional, Set, Tuple
 
+from genutility.filesystem import scandir_error_log_warning, scandir_rec
 from PIL import Image, UnidentifiedImageError
 
 logger = logging.getLogger(__name__)
 
 
-def convert(inpath: Path, bitmap: bool = True, tiff: bool = True, remove_originals: bool = False) -> None:
+def _init_worker(level: int) -> None:
+    logging.basicConfig(level=level)
+
+
+def _convert_one(path: Path, suffix: str, remove_originals: bool) -> None:
+    if suffix == ".bmp":
+        pngfile = path.with_suffix(".png")
+        if not pngfile.exists():
+            try:
+                Image.open(path).save(pngfile, compress_level=9)
+                copystat(path, pngfile)
+                logger.info("Converted: %s\n-> %s", path, pngfile)
+
+                if remove_originals:
+                    path.unlink()
+            except UnidentifiedImageError as e:
+                logger.warning("%s", e)
+
+    else:
+        newfile = path.with_suffix(".new" + path.suffix)
+        if not newfile.exists():
+            im = Image.open(path)
+            if im.info["compression"] in {"raw", "tiff_raw_16", "packbits", "tiff_lzw"}:  # bad lossless compression
+                im.save(str(newfile), "tiff", compression="tiff_deflate", tiffinfo=im.tag)  # might lose metadata
+
+                if newfile.stat().st_size >= path.stat().st_size:
+                    logger.info("Tried to convert %s, but the result file was larger than the original", path)
+                    newfile.unlink()
+                    return
+
+                copystat(path, newfile)
+                logger.info("Converted: %s\n-> %s", path, newfile)
+
+                if remove_originals:
+                    del im
+                    os.replace(newfile, path)
+
+            elif im.info["compression"] in {"tiff_adobe_deflate", "tiff_deflate"}:  # good lossless compression
+                logger.debug("%s is already compressed", path)
+
+            elif im.info["compression"] in {"tiff_jpeg", "jpeg"}:  # lossy compression
+                logger.debug("%s is already lossy compressed", path)
+
+            elif im.info["compression"] in {
+                "tiff_ccitt",
+                "group3",
+                "group4",
+                "tiff_thunderscan",
+                "tiff_sgilog",
+                "tiff_sgilog24",
+                "lzma",
+                "zstd",
+                "webp",
+            }:
+                raise RuntimeError(f"{path} uses an unhandled TIFF compression : {im.info}")
+
+            else:
+                raise RuntimeError(f"{path} uses an unknown TIFF compression : {im.info}")
+
+
+def convert(
+    inpath: Path,
+    bitmap: bool = True,
+    tiff: bool = True,
+    remove_originals: bool = False,
+    workers: Optional[int] = None,
+) -> None:
     """Recursively within `inpath`, converts bitmap files to PNG
     and uncompressed tiff files to losslessly compressed ones.
     """
 
-    for path in inpath.rglob("*"):
-        if bitmap and path.suffix in {".bmp"}:
-            pngfile = path.with_suffix(".png")
-            if not pngfile.exists():
-                try:
-                    Image.open(path).save(pngfile, compress_level=9)
-                    copystat(path, pngfile)
-                    logger.info("Converted: %s\n-> %s", path, pngfile)
-
-                    if remove_originals:
-                        path.unlink()
-                except UnidentifiedImageError as e:
-                    logger.warning("%s", e)
-
-        if tiff and path.suffix in {".tif", ".tiff"}:
-            newfile = path.with_suffix(".new" + path.suffix)
-            if not newfile.exists():
-                im = Image.open(path)
-                if im.info["compression"] in {"raw", "tiff_raw_16", "packbits", "tiff_lzw"}:  # bad lossless compression
-                    im.save(str(newfile), "tiff", compression="tiff_deflate", tiffinfo=im.tag)  # might lose metadata
-
-                    if newfile.stat().st_size >= path.stat().st_size:
-                        logger.info("Tried to convert %s, but the result file was larger than the original", path)
-                        newfile.unlink()
-                        continue
-
-                    copystat(path, newfile)
-                    logger.info("Converted: %s\n-> %s", path, newfile)
-
-                    if remove_originals:
-                        del im
-                        os.replace(newfile, path)
-
-                elif im.info["compression"] in {"tiff_adobe_deflate", "tiff_deflate"}:  # good lossless compression
-                    logger.debug("%s is already compressed", path)
-
-                elif im.info["compression"] in {"tiff_jpeg", "jpeg"}:  # lossy compression
-                    logger.debug("%s is already lossy compressed", path)
-
-                elif im.info["compression"] in {
-                    "tiff_ccitt",
-                    "group3",
-                    "group4",
-                    "tiff_thunderscan",
-                    "tiff_sgilog",
-                    "tiff_sgilog24",
-                    "lzma",
-                    "zstd",
-                    "webp",
-                }:
-                    raise RuntimeError(f"{path} uses an unhandled TIFF compression : {im.info}")
-
-                else:
-                    raise RuntimeError(f"{path} uses an unknown TIFF compression : {im.info}")
+    suffixes: Set[str] = set()
+    if bitmap:
+        suffixes.add(".bmp")
+    if tiff:
+        suffixes.update((".tif", ".tiff"))
+
+    # collect all candidates first, so files written by the workers are not picked up by the scan
+    candidates: List[Tuple[Path, str]] = []
+    for entry in scandir_rec(
+        inpath, files=True, dirs=False, others=False, follow_symlinks=False, errorfunc=scandir_error_log_warning
+    ):
+        suffix = os.path.splitext(entry.name)[1].lower()
+        if suffix in suffixes:
+            candidates.append((Path(entry.path), suffix))
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(logging.getLogger().level,)) as executor:
+        futures = [executor.submit(_convert_one, path, suffix, remove_originals) for path, suffix in candidates]
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
@@ -81,6 +115,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "--remove-originals", action="store_true", help="Remove the original image files after they have been converted"
     )
+    parser.add_argument(
+        "--workers", metavar="N", type=int, default=None, help="Number of processes used to convert images"
+    )
     parser.add_argument("-v", "--verbose", action="store_true", help="Display debug messages")
     args = parser.parse_args()
 
@@ -90,4 +127,10 @@ if __name__ == "__main__":
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
 
-    convert(args.path, bitmap=args.bitmaps, tiff=args.tiffs, remove_originals=args.remove_originals)
+    convert(
+        args.path,
+        bitmap=args.bitmaps,
+        tiff=args.tiffs,
+        remove_originals=args.remove_originals,
+        workers=args.workers,
+    )
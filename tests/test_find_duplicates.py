@@ -0,0 +1,48 @@
+import importlib.util
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+SCRIPT = Path(__file__).resolve().parent.parent / "find-duplicates.py"
+
+
+@pytest.fixture(scope="module")
+def fd():
+    spec = importlib.util.spec_from_file_location("find_duplicates", SCRIPT)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except ImportError as e:
+        pytest.skip(f"missing dependency: {e}")
+    return module
+
+
+class NoProgress:
+    def track(self, it, **kwargs):
+        return it
+
+
+def _groups(fd, tmp_path, cache=None):
+    groups = fd.dupegroups([tmp_path / "files"], fd.xxh3, NoProgress(), False, hashcls=fd.xxh3_128, cache=cache)
+    return sorted(sorted(os.path.basename(path) for path in paths) for paths in groups.values())
+
+
+def test_dupegroups_cache_lone_miss(fd, tmp_path):
+    # the new copy is the only uncached file of its size, so it has no partner in the sample stage
+    files = tmp_path / "files"
+    files.mkdir()
+    data = os.urandom(fd.SAMPLE_SIZE * 3)
+    for name in ("a", "b", "c"):
+        (files / name).write_bytes(data)
+
+    with fd.HashCache(tmp_path / "cache.sqlite", "xxh3") as cache:
+        assert _groups(fd, tmp_path, cache) == [["a", "b", "c"]]
+
+    shutil.copyfile(files / "a", files / "d")
+
+    assert _groups(fd, tmp_path) == [["a", "b", "c", "d"]]
+    with fd.HashCache(tmp_path / "cache.sqlite", "xxh3") as cache:
+        assert _groups(fd, tmp_path, cache) == [["a", "b", "c", "d"]]